@@ -1,155 +1,432 @@
 import os
+import re
 import httpx
 import sqlite3
 import secrets
-import json
+import hashlib
+import orjson
 import logging
 import asyncio
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, HTTPException, Depends, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
+from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse
 
+# Fallback caso o runner não passe --loop uvloop (ex.: execução local)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # --- Configurações ---
 MASTER_API_KEY = os.getenv("MASTER_API_KEY") or os.getenv("API_KEY")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
-ALWAYS_ON_MODELS = [m.strip() for m in os.getenv("ALWAYS_ON_MODELS", "").split(",") if m.strip()]
+# Tupla preserva a ordem do .env para o aquecimento; o frozenset dá
+# teste de pertinência O(1) nos caminhos quentes
+_ALWAYS_ON_ORDER = tuple(m.strip() for m in os.getenv("ALWAYS_ON_MODELS", "").split(",") if m.strip())
+ALWAYS_ON_MODELS = frozenset(_ALWAYS_ON_ORDER)
 DB_PATH = "/app/data/guard.db"
 
+# Extrai o "model" do corpo sem parsear o JSON inteiro (o prompt pode ter MBs)
+_MODEL_RE = re.compile(rb'"model"\s*:\s*"([^"\\]{1,200})"')
+
+# Cabeçalhos que não devem ser repassados ao Ollama: hop-by-hop, host e
+# content-length (o corpo segue re-chunkado), e a chave do cliente
+_HOP_HEADERS = frozenset((b"connection", b"keep-alive", b"proxy-authenticate", b"proxy-authorization",
+                          b"te", b"trailer", b"transfer-encoding", b"upgrade",
+                          b"host", b"content-length", b"authorization"))
+
+# Sentinelas em bytes (as duas grafias que o Ollama emite): a detecção do
+# fim do stream nunca precisa decodificar UTF-8
+_DONE_SENTINEL = b'"done":true'
+_DONE_SENTINEL2 = b'"done": true'
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("AI_GUARD")
 
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
+# Timestamp ISO com cache por segundo: os registros de log/catálogo não
+# precisam de sub-segundo, então o datetime só é formatado quando o segundo vira
+_NOW_CACHE = [0, ""]
+
+def _now_iso():
+    ts = int(time.time())
+    if ts != _NOW_CACHE[0]:
+        _NOW_CACHE[0] = ts
+        _NOW_CACHE[1] = datetime.now().isoformat(timespec="seconds")
+    return _NOW_CACHE[1]
+
+# Cliente HTTP compartilhado com o Ollama: criado uma vez no lifespan,
+# reutiliza conexões keep-alive em vez de abrir socket novo por chamada
+ollama_client: httpx.AsyncClient = None
+
 # --- Banco de Dados ---
+# Uma conexão persistente por thread (threads do executor + a principal):
+# evita reabrir o arquivo e reaplicar PRAGMAs a cada consulta. Só o
+# journal_mode=WAL fica gravado no arquivo; synchronous, temp_store,
+# mmap_size, cache_size e busy_timeout são por conexão e vão no _conn().
+_TLS = threading.local()
+
+# SQL dos caminhos quentes como constantes de módulo: a mesma string
+# interna sempre acerta o cache de statements preparados da conexão
+_SQL_SELECT_KEY = "SELECT name, email FROM api_keys WHERE key_hash = ?"
+_SQL_INSERT_KEY = "INSERT INTO api_keys (key_hash, name, email, created_at) VALUES (?, ?, ?, ?)"
+_SQL_INSERT_USAGE = "INSERT INTO usage_logs (key, model, prompt_tokens, eval_tokens, timestamp) VALUES (?, ?, ?, ?, ?)"
+_SQL_INSERT_CATALOG = "INSERT INTO model_catalog (name, size, type, last_seen) VALUES (?, ?, ?, ?)"
+
+# Registro de todas as conexões vivas para fechá-las no shutdown
+# (o close dispara o checkpoint final do WAL)
+_ALL_CONNS: list = []
+
+def _conn():
+    conn = getattr(_TLS, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-65536")
+        _TLS.conn = conn
+        _ALL_CONNS.append(conn)
+    return conn
+
+def _close_all_conns():
+    _DB_EXECUTOR.shutdown(wait=True)
+    for conn in _ALL_CONNS:
+        try: conn.close()
+        except: pass
+    _ALL_CONNS.clear()
+
+# Executor dedicado e limitado: o sqlite3 é síncrono, então todo acesso
+# sai do event loop para cá (4 workers = no máx. 4 escritores concorrentes)
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+
+def _sync_fetchall(sql, params=()):
+    return _conn().execute(sql, params).fetchall()
+
+def _sync_execute(sql, params=()):
+    conn = _conn()
+    conn.execute(sql, params)
+    conn.commit()
+
+async def _db_fetchall(sql, params=()):
+    return await asyncio.get_running_loop().run_in_executor(_DB_EXECUTOR, _sync_fetchall, sql, params)
+
+async def _db_execute(sql, params=()):
+    await asyncio.get_running_loop().run_in_executor(_DB_EXECUTOR, _sync_execute, sql, params)
+
 def init_db():
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = _conn()
         c = conn.cursor()
+        # WAL permite leituras concorrentes com escritas e reduz fsyncs;
+        # é o único PRAGMA persistente no arquivo, então basta rodar aqui
+        c.execute("PRAGMA journal_mode=WAL")
+        # A chave crua nunca fica no banco: só o SHA-256 (BLOB de 32 bytes,
+        # nó de índice menor e comparação em tempo constante)
         c.execute('''CREATE TABLE IF NOT EXISTS api_keys
-                     (key TEXT PRIMARY KEY, name TEXT, email TEXT, created_at TEXT)''')
+                     (key_hash BLOB PRIMARY KEY, name TEXT, email TEXT, created_at TEXT)''')
         c.execute('''CREATE TABLE IF NOT EXISTS usage_logs
                      (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, model TEXT, 
                       prompt_tokens INTEGER, eval_tokens INTEGER, timestamp TEXT)''')
         c.execute('''CREATE TABLE IF NOT EXISTS model_catalog
                      (name TEXT PRIMARY KEY, size INTEGER, type TEXT, last_seen TEXT)''')
+        # Índices para o dashboard: JOIN/GROUP BY por chave e ORDER BY
+        # timestamp DESC viram buscas de índice em vez de full scan
+        c.execute("CREATE INDEX IF NOT EXISTS idx_usage_key ON usage_logs(key)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_usage_ts ON usage_logs(timestamp DESC)")
+        # Migração de bancos antigos que guardavam a chave em texto puro.
+        # Transação explícita (a conexão é autocommit): ou migra tudo, ou
+        # nada — falha no meio não pode deixar api_keys pela metade
+        cols = [r[1] for r in c.execute("PRAGMA table_info(api_keys)").fetchall()]
+        if "key" in cols:
+            old_rows = c.execute("SELECT key, name, email, created_at FROM api_keys").fetchall()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                c.execute("ALTER TABLE api_keys RENAME TO api_keys_plain")
+                c.execute('''CREATE TABLE api_keys
+                             (key_hash BLOB PRIMARY KEY, name TEXT, email TEXT, created_at TEXT)''')
+                for key, name, email, created_at in old_rows:
+                    h = hashlib.sha256(key.encode()).digest()
+                    c.execute("INSERT OR REPLACE INTO api_keys VALUES (?, ?, ?, ?)", (h, name, email, created_at))
+                    c.execute("UPDATE usage_logs SET key = ? WHERE key = ?", (h, key))
+                c.execute("DROP TABLE api_keys_plain")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        c.execute("ANALYZE")
         conn.commit()
-        conn.close()
         logger.info("Banco de dados inicializado.")
     except Exception as e:
         logger.error(f"Erro DB Init: {e}")
 
-async def log_usage(key: str, model: str, prompt_tokens: int, eval_tokens: int):
+# Fila de escrita única: os INSERTs de uso saem do caminho da resposta
+# e são persistidos em lote pelo usage_writer. Limitada: se o writer
+# travar, é melhor perder log de uso do que crescer memória sem teto.
+USAGE_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=10000)
+
+def log_usage(key: bytes, model: str, prompt_tokens: int, eval_tokens: int):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("INSERT INTO usage_logs (key, model, prompt_tokens, eval_tokens, timestamp) VALUES (?, ?, ?, ?, ?)",
-                  (key, model, prompt_tokens, eval_tokens, datetime.now().isoformat()))
+        USAGE_QUEUE.put_nowait((key, model, prompt_tokens, eval_tokens, _now_iso()))
+    except asyncio.QueueFull:
+        logger.error("Fila de usage_logs cheia; registro descartado")
+
+def _flush_usage_rows(rows):
+    try:
+        conn = _conn()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(_SQL_INSERT_USAGE, rows)
         conn.commit()
-        conn.close()
     except Exception as e:
         logger.error(f"Erro log usage: {e}")
+        # Conexão é persistente: desfaz a transação para não deixá-la presa
+        try: _conn().rollback()
+        except: pass
+
+async def usage_writer():
+    rows = []
+    try:
+        while True:
+            rows.append(await USAGE_QUEUE.get())
+            try:
+                # Junta o que chegar em até 10ms (máx. 256 linhas) num commit só
+                while len(rows) < 256:
+                    rows.append(await asyncio.wait_for(USAGE_QUEUE.get(), timeout=0.01))
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.get_running_loop().run_in_executor(_DB_EXECUTOR, _flush_usage_rows, rows)
+            rows = []
+    except asyncio.CancelledError:
+        # Shutdown: persiste o lote já retirado da fila antes de encerrar
+        if rows:
+            _flush_usage_rows(rows)
+        raise
 
 # --- Gerenciamento de Modelos ---
+def _sync_replace_catalog(models):
+    now_iso = _now_iso()
+    rows = [(m["name"], m.get("size", 0),
+             "always_on" if m["name"] in ALWAYS_ON_MODELS else "on_demand", now_iso)
+            for m in models]
+    conn = _conn()
+    try:
+        c = conn.cursor()
+        # Uma transação só: um fsync para a troca inteira do catálogo
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM model_catalog")
+        c.executemany(_SQL_INSERT_CATALOG, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# Cópia em memória do catálogo: o /api/available_models serve daqui,
+# sem tocar no SQLite (a tabela só muda quando o refresh roda). A resposta
+# já fica serializada em bytes, pronta para devolver sem encode por chamada.
+_CATALOG_CACHE: list = []
+_CATALOG_BYTES: bytes = orjson.dumps({"models": []})
+
+async def load_catalog_from_db():
+    # Semeia o cache com o último catálogo persistido: se o Ollama estiver
+    # fora do ar na subida, servimos a lista da execução anterior em vez
+    # de vazio até alguém chamar /admin/refresh_catalog
+    global _CATALOG_BYTES
+    rows = await _db_fetchall("SELECT name, size, type FROM model_catalog")
+    if rows:
+        _CATALOG_CACHE[:] = [dict(r) for r in rows]
+        _CATALOG_BYTES = orjson.dumps({"models": _CATALOG_CACHE})
+
 async def refresh_model_catalog():
-    async with httpx.AsyncClient(base_url=OLLAMA_URL) as client:
-        try:
-            resp = await client.get("/api/tags")
-            if resp.status_code != 200: return
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("DELETE FROM model_catalog")
-            for m in resp.json().get("models", []):
-                name = m["name"]
-                c.execute("INSERT INTO model_catalog (name, size, type, last_seen) VALUES (?, ?, ?, ?)",
-                          (name, m.get("size", 0), "always_on" if name in ALWAYS_ON_MODELS else "on_demand", datetime.now().isoformat()))
-            conn.commit()
-            conn.close()
-        except: pass
+    global _CATALOG_BYTES
+    try:
+        resp = await ollama_client.get("/api/tags")
+        if resp.status_code != 200: return
+        models = resp.json().get("models", [])
+        await asyncio.get_running_loop().run_in_executor(_DB_EXECUTOR, _sync_replace_catalog, models)
+        _CATALOG_CACHE[:] = [
+            {"name": m["name"], "size": m.get("size", 0),
+             "type": "always_on" if m["name"] in ALWAYS_ON_MODELS else "on_demand"}
+            for m in models]
+        _CATALOG_BYTES = orjson.dumps({"models": _CATALOG_CACHE})
+    except: pass
 
 async def ensure_always_on_models():
-    async with httpx.AsyncClient(base_url=OLLAMA_URL, timeout=120.0) as client:
-        for model in ALWAYS_ON_MODELS:
-            try:
-                await client.post("/api/generate", json={"model": model, "keep_alive": -1})
-            except: pass
+    # Aquece todos em paralelo: o startup espera o mais lento, não a soma
+    results = await asyncio.gather(
+        *[ollama_client.post("/api/generate", json={"model": m, "keep_alive": -1}, timeout=120.0)
+          for m in _ALWAYS_ON_ORDER],
+        return_exceptions=True)
+    for model, res in zip(_ALWAYS_ON_ORDER, results):
+        if isinstance(res, Exception):
+            logger.error(f"Erro ao aquecer {model}: {res}")
+
+# Serializa o swap de modelos pesados: sem o lock, dois pedidos simultâneos
+# de modelos diferentes descarregam um ao outro e estouram a VRAM
+_HEAVY_LOCK = asyncio.Lock()
+
+# Snapshot do /api/ps com TTL curto: numa rajada de requisições o gateway
+# consulta o Ollama uma vez e as demais reutilizam a mesma lista
+_PS_CACHE = {"ts": 0.0, "models": []}
+_PS_TTL = 2.0
+
+async def _get_loaded_models():
+    if time.monotonic() - _PS_CACHE["ts"] < _PS_TTL:
+        return _PS_CACHE["models"]
+    ps = await ollama_client.get("/api/ps")
+    names = [m["name"] for m in ps.json().get("models", [])]
+    _PS_CACHE["ts"] = time.monotonic()
+    _PS_CACHE["models"] = names
+    return names
+
+async def _unload_other_heavies(target_model: str):
+    try:
+        for name in list(await _get_loaded_models()):
+            if name != target_model and name not in ALWAYS_ON_MODELS:
+                await ollama_client.post("/api/generate", json={"model": name, "keep_alive": 0})
+                # Mantém o snapshot coerente dentro do TTL: sem isso, a
+                # próxima requisição re-descarrega (e re-carrega!) a vítima
+                if name in _PS_CACHE["models"]:
+                    _PS_CACHE["models"].remove(name)
+    except: pass
+
+# Coalescência: N pedidos simultâneos do mesmo modelo pesado viram uma
+# única rodada de /api/ps + descargas; os demais aguardam a mesma task
+_INFLIGHT: dict = {}
+
+async def _do_manage(target_model: str):
+    async with _HEAVY_LOCK:
+        await _unload_other_heavies(target_model)
 
 async def manage_heavy_load(target_model: str):
     if target_model in ALWAYS_ON_MODELS: return
-    async with httpx.AsyncClient(base_url=OLLAMA_URL) as client:
-        try:
-            ps = await client.get("/api/ps")
-            for m in ps.json().get("models", []):
-                if m["name"] != target_model and m["name"] not in ALWAYS_ON_MODELS:
-                    await client.post("/api/generate", json={"model": m["name"], "keep_alive": 0})
-        except: pass
+    # Se o snapshot recente já mostra o alvo carregado, nada a fazer
+    if time.monotonic() - _PS_CACHE["ts"] < _PS_TTL and target_model in _PS_CACHE["models"]:
+        return
+    task = _INFLIGHT.get(target_model)
+    if task is None:
+        task = asyncio.create_task(_do_manage(target_model))
+        _INFLIGHT[target_model] = task
+        task.add_done_callback(lambda t: _INFLIGHT.pop(target_model, None))
+    await task
 
 # --- Ciclo de Vida ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global ollama_client
+    ollama_client = httpx.AsyncClient(
+        base_url=OLLAMA_URL,
+        timeout=httpx.Timeout(300.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50,
+                            keepalive_expiry=60))
+    app.state.ollama = ollama_client
     init_db()
+    await load_catalog_from_db()
     await refresh_model_catalog()
     await ensure_always_on_models()
+    writer_task = asyncio.create_task(usage_writer())
     yield
+    # Descarrega o que ainda estiver na fila antes de encerrar; o await
+    # garante que o writer gravou o lote que já tinha em mãos
+    writer_task.cancel()
+    try:
+        await writer_task
+    except asyncio.CancelledError:
+        pass
+    pending = []
+    while not USAGE_QUEUE.empty():
+        pending.append(USAGE_QUEUE.get_nowait())
+    if pending:
+        _flush_usage_rows(pending)
+    _close_all_conns()
+    await ollama_client.aclose()
 
-app = FastAPI(lifespan=lifespan)
+# orjson (C) no lugar do json puro-Python para serializar as respostas
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 security = HTTPBearer()
 
 # --- Autenticação ---
+# Cache TTL de chaves válidas: poupa um SELECT no SQLite por requisição
+_KEY_CACHE: dict = {}
+_KEY_CACHE_TTL = 60.0
+_KEY_CACHE_MAX = 10000
+
 async def verify_credentials(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
-    if MASTER_API_KEY and token == MASTER_API_KEY:
+    # compare_digest: tempo constante, não vaza o prefixo da chave mestra.
+    # Comparação em bytes: com str ele rejeita tokens não-ASCII com TypeError
+    if MASTER_API_KEY and secrets.compare_digest(token.encode(), MASTER_API_KEY.encode()):
         return {"type": "master", "key": token}
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, email FROM api_keys WHERE key = ?", (token,))
-    user = cursor.fetchone()
-    conn.close()
-    
+
+    cached = _KEY_CACHE.get(token)
+    if cached and time.monotonic() - cached[0] < _KEY_CACHE_TTL:
+        return cached[1]
+
+    key_hash = hashlib.sha256(token.encode()).digest()
+    rows = await _db_fetchall(_SQL_SELECT_KEY, (key_hash,))
+    user = rows[0] if rows else None
+
     if user:
-        return {"type": "user", "key": token, "name": user[0], "email": user[1]}
-    
+        auth = {"type": "user", "key": token, "key_hash": key_hash, "name": user[0], "email": user[1]}
+        if len(_KEY_CACHE) >= _KEY_CACHE_MAX:
+            _KEY_CACHE.clear()
+        _KEY_CACHE[token] = (time.monotonic(), auth)
+        return auth
+
     raise HTTPException(status_code=401, detail="Invalid API Key")
 
+# Healthcheck sem autenticação e sem serialização por chamada: os probes
+# do compose batem aqui com frequência e recebem bytes pré-serializados.
+# Precisa vir antes da rota coringa /api/{path} e do mount estático.
+_HEALTH_BYTES = orjson.dumps({"status": "online"})
+
+@app.get("/health")
+async def health():
+    # async: handler sync iria para o threadpool do anyio a cada probe
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
+
 # --- ENDPOINTS NOVOS (DASHBOARD) ---
 
 @app.get("/admin/dashboard_stats")
-def get_dashboard_stats(auth: dict = Depends(verify_credentials)):
+async def get_dashboard_stats(auth: dict = Depends(verify_credentials)):
     if auth["type"] != "master":
         raise HTTPException(status_code=403, detail="Apenas Master Key")
-    
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
+
     # Busca chaves e soma tokens de uso
     query = '''
         SELECT 
-            k.name, 
-            k.email, 
-            k.key, 
+            k.name,
+            k.email,
+            hex(k.key_hash) as key,
             k.created_at,
             COALESCE(SUM(u.prompt_tokens), 0) as total_prompt,
             COALESCE(SUM(u.eval_tokens), 0) as total_eval,
             COUNT(u.id) as request_count
         FROM api_keys k
-        LEFT JOIN usage_logs u ON k.key = u.key
-        GROUP BY k.key
+        LEFT JOIN usage_logs u ON k.key_hash = u.key
+        GROUP BY k.key_hash
         ORDER BY k.created_at DESC
     '''
-    c.execute(query)
-    clients = [dict(row) for row in c.fetchall()]
-    
-    # Busca logs recentes (últimos 50)
-    c.execute("SELECT * FROM usage_logs ORDER BY timestamp DESC LIMIT 50")
-    logs = [dict(row) for row in c.fetchall()]
-    
-    conn.close()
-    return {"clients": clients, "recent_logs": logs}
+    # As duas consultas rodam em paralelo em threads do executor;
+    # a agregação inteira fica no SQLite (em C), não no Python
+    client_rows, log_rows = await asyncio.gather(
+        _db_fetchall(query),
+        _db_fetchall("SELECT id, hex(key) as key, model, prompt_tokens, eval_tokens, timestamp "
+                     "FROM usage_logs ORDER BY timestamp DESC LIMIT 50"))
+
+    return {"clients": list(map(dict, client_rows)), "recent_logs": list(map(dict, log_rows))}
 
 # Endpoint para criar chave (Mantido e ajustado)
 @app.post("/admin/create_key")
@@ -163,73 +440,143 @@ async def create_key(request: Request, auth: dict = Depends(verify_credentials))
     
     new_key = f"pbpm-{secrets.token_urlsafe(48)}"
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute("INSERT INTO api_keys (key, name, email, created_at) VALUES (?, ?, ?, ?)",
-                  (new_key, name, email, datetime.now().isoformat()))
-        conn.commit(); conn.close()
+        # Só o hash vai para o banco; a chave crua aparece uma única vez na resposta
+        await _db_execute(_SQL_INSERT_KEY,
+                          (hashlib.sha256(new_key.encode()).digest(), name, email, _now_iso()))
     except Exception as e: raise HTTPException(500, str(e))
-    
+
+    _KEY_CACHE.pop(new_key, None)
     return {"message": "Criado", "api_key": new_key, "registered_to": {"name": name, "email": email}}
 
 # Endpoints padrão (Available models, Preload, Gateway)
 @app.get("/api/available_models")
-def list_models(auth: dict = Depends(verify_credentials)):
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row
-    rows = conn.execute("SELECT name, size, type FROM model_catalog").fetchall()
-    conn.close()
-    return {"models": [dict(r) for r in rows]}
+async def list_models(auth: dict = Depends(verify_credentials)):
+    return Response(content=_CATALOG_BYTES, media_type="application/json")
+
+@app.post("/admin/refresh_catalog")
+async def refresh_catalog(auth: dict = Depends(verify_credentials)):
+    if auth["type"] != "master":
+        raise HTTPException(status_code=403, detail="Apenas Master Key")
+    await refresh_model_catalog()
+    return {"models": _CATALOG_CACHE}
 
 @app.post("/preload")
 async def preload_model(request: Request, auth: dict = Depends(verify_credentials)):
     body = await request.json()
     model = body.get("model")
-    if model:
-        await manage_heavy_load(model)
-        async with httpx.AsyncClient(base_url=OLLAMA_URL) as client:
-            await client.post("/api/generate", json={"model": model, "keep_alive": "10m"})
+    if model and model not in ALWAYS_ON_MODELS:
+        # Segura o lock durante descarga + carga para o swap ser atômico
+        async with _HEAVY_LOCK:
+            await _unload_other_heavies(model)
+            await ollama_client.post("/api/generate", json={"model": model, "keep_alive": "10m"})
+            # Registra a carga no snapshot para o fast-path acertar no TTL
+            if model not in _PS_CACHE["models"]:
+                _PS_CACHE["models"].append(model)
+        await refresh_model_catalog()
     return {"status": "ready", "model": model}
 
-@app.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-async def gateway(path: str, request: Request, auth: dict = Depends(verify_credentials)):
-    if auth["type"] == "master" and ("generate" in path or "chat" in path):
-        raise HTTPException(403, "Master key não faz inferência")
-    
+async def _proxy(path: str, request: Request, auth: dict):
     client_req_content = None
     if request.method == "POST":
-        body_bytes = await request.body()
+        # Espia só os primeiros ~16KB do corpo para achar o "model";
+        # o resto segue direto para o Ollama sem bufferizar o prompt inteiro
+        body_iter = request.stream().__aiter__()
+        peek = b""
         try:
-            if "model" in json.loads(body_bytes):
-                await manage_heavy_load(json.loads(body_bytes)["model"])
-        except: pass
-        async def body_stream(): yield body_bytes
+            while len(peek) < 16384:
+                peek += await body_iter.__anext__()
+        except StopAsyncIteration:
+            pass
+
+        model = None
+        m = _MODEL_RE.search(peek)
+        if m:
+            model = m.group(1).decode()
+        else:
+            try: model = orjson.loads(peek).get("model")
+            except Exception: pass
+        if model:
+            await manage_heavy_load(model)
+
+        async def body_stream():
+            if peek: yield peek
+            async for part in body_iter:
+                yield part
         client_req_content = body_stream()
 
-    client = httpx.AsyncClient(base_url=OLLAMA_URL)
+    client = request.app.state.ollama
     # Correção: Adicionamos f"api/{path}" para reconstruir a URL correta (/api/chat)
     url = httpx.URL(path=f"api/{path}", query=request.url.query.encode("utf-8"))
-    req = client.build_request(request.method, url, headers=request.headers.raw, content=client_req_content, timeout=300.0)
+    fwd_headers = [(k, v) for k, v in request.headers.raw if k not in _HOP_HEADERS]
+    req = client.build_request(request.method, url, headers=fwd_headers, content=client_req_content, timeout=300.0)
     
     try: r = await client.send(req, stream=True)
     except Exception as e: raise HTTPException(500, f"Ollama error: {e}")
 
+    # Só a última linha do NDJSON traz as contagens de tokens, então o loop
+    # de streaming guarda apenas um rabo limitado e o parse acontece uma vez
+    # só. 64KB porque a linha final do /api/generate inclui o array "context",
+    # que facilmente passa de dezenas de KB.
+    tail = {"buf": b""}
+
     async def stream_processor():
-        prompt_t, eval_t = 0, 0
-        async for chunk in r.aiter_raw():
+        # chunk_size é teto, não espera: tokens chegam assim que disponíveis,
+        # mas rajadas grandes custam menos iterações de Python
+        async for chunk in r.aiter_raw(chunk_size=65536):
             yield chunk
-            try:
-                txt = chunk.decode("utf-8", errors="ignore")
-                if '"done":true' in txt or '"done": true' in txt:
-                    for line in txt.split("\n"):
-                        if '"done":' in line:
-                            d = json.loads(line)
-                            prompt_t = d.get("prompt_eval_count", 0)
-                            eval_t = d.get("eval_count", 0)
-            except: pass
-        await r.aclose(); await client.aclose()
-        if auth["type"] == "user": await log_usage(auth["key"], "unknown", prompt_t, eval_t)
-
-    return StreamingResponse(stream_processor(), status_code=r.status_code, headers=r.headers)
+            tail["buf"] = (tail["buf"] + chunk)[-65536:]
+
+    async def finalize():
+        # Roda depois da resposta terminar: fecha o stream e contabiliza o uso
+        await r.aclose()
+        prompt_t, eval_t = 0, 0
+        buf = tail["buf"]
+        if _DONE_SENTINEL in buf or _DONE_SENTINEL2 in buf:
+            # As contagens vêm na última linha completa; varre de trás pra frente
+            for line in reversed(buf.split(b"\n")):
+                if b'"done":' in line:
+                    try:
+                        d = orjson.loads(line)
+                    except Exception:
+                        continue
+                    prompt_t = d.get("prompt_eval_count", 0)
+                    eval_t = d.get("eval_count", 0)
+                    break
+        if auth["type"] == "user": log_usage(auth["key_hash"], "unknown", prompt_t, eval_t)
+
+    # Sem content-length/transfer-encoding (o Starlette re-chunka a resposta)
+    # e com x-accel-buffering: no para o nginx não bufferizar o stream
+    resp_headers = dict(r.headers)
+    for h in ("content-length", "transfer-encoding", "connection"):
+        resp_headers.pop(h, None)
+    resp_headers["x-accel-buffering"] = "no"
+    resp_headers["cache-control"] = "no-cache"
+
+    return StreamingResponse(stream_processor(), status_code=r.status_code, headers=resp_headers,
+                             background=BackgroundTask(finalize))
+
+# Rotas explícitas para os endpoints de inferência (99% do tráfego): o
+# match é O(1) na árvore de rotas, sem regex da rota coringa, e o bloqueio
+# da chave mestra vira decisão de rota em vez de busca por substring
+@app.post("/api/chat")
+@app.post("/api/generate")
+async def inference(request: Request, auth: dict = Depends(verify_credentials)):
+    if auth["type"] == "master":
+        raise HTTPException(403, "Master key não faz inferência")
+    return await _proxy(request.url.path.removeprefix("/api/"), request, auth)
+
+# Coringa para o restante da API do Ollama (tags, show, embeddings, ...)
+@app.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+async def gateway(path: str, request: Request, auth: dict = Depends(verify_credentials)):
+    if auth["type"] == "master" and ("generate" in path or "chat" in path):
+        raise HTTPException(403, "Master key não faz inferência")
+    return await _proxy(path, request, auth)
 
 # --- SERVIR STATIC FILES (DASHBOARD) ---
-# Monta a pasta 'static' para servir o HTML
-app.mount("/", StaticFiles(directory="static", html=True), name="static")
\ No newline at end of file
+# O mount sai da raiz: montado em "/", o Starlette fazia um os.stat na
+# pasta static para toda rota desconhecida antes de responder 404
+@app.get("/")
+async def dashboard():
+    return FileResponse("static/index.html")
+
+app.mount("/ui", StaticFiles(directory="static", html=True), name="static")
\ No newline at end of file